@@ -15,8 +15,6 @@ import simplejson as json
 from matplotlib import rc
 from matplotlib.colors import LogNorm
 from matplotlib.ticker import MaxNLocator
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from mpl_toolkits.mplot3d import Axes3D
 from scipy.interpolate import interp1d
 
 import palettable
@@ -2,14 +2,29 @@
 Analysis procedures for particle energy spectrum fitting.
 """
 import collections
+import gc
+import glob
 import math
+import multiprocessing
 import os.path
 
+import h5py
 import matplotlib as mpl
+if 'DISPLAY' not in os.environ:
+    # Headless batch runs, so use a non-interactive backend
+    mpl.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
+from joblib import Parallel, delayed
 from matplotlib import rc
-from scipy.optimize import curve_fit
+from matplotlib.collections import LineCollection
+from scipy.ndimage import maximum_filter1d, uniform_filter1d
+from scipy.optimize import leastsq
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 import color_maps as cm
 import colormap.colormaps as cmaps
@@ -34,6 +49,45 @@ font = {
     'size': 24,
 }
 
+# PIC information of each run, spectrum time frames of each directory and
+# energy distributions read from the spectrum files
+pic_info_cache = {}
+spectrum_frames_cache = {}
+energy_distribution_cache = {}
+
+img_spectra_dir = '../img/spectra/'
+mkdir_p(img_spectra_dir)
+
+# Whether to show the figures after saving them
+show_plots = False
+
+# Power-law fitting ranges of the runs in plot_guide_electron and
+# plot_guide_ion
+guide_electron_offset = (50, 70, 70, 80, 40)
+guide_electron_extent = (100, 50, 40, 40, 40)
+guide_ion_offset = (40, 40, 40, 40, 70)
+guide_ion_extent = (25, 25, 25, 25, 35)
+
+power_fitting = collections.namedtuple(
+    "power_fitting",
+    ['fpower', 'es', 'ee', 'params', 'nfraction', 'efraction'])
+
+
+def _accumulate_kernel(ene, f, nacc_ene, eacc_ene):
+    """Fill the accumulated particle number and energy in one pass.
+    """
+    nacc_ene[0] = f[0] * ene[0]
+    eacc_ene[0] = 0.5 * f[0] * ene[0]**2
+    for i in range(1, f.shape[0]):
+        ene_sum = ene[i] + ene[i - 1]
+        nacc_ene[i] = f[i] * ene_sum * 0.5 + nacc_ene[i - 1]
+        eacc_ene[i] = 0.5 * f[i] * (ene[i] - ene[i - 1]) * ene_sum
+        eacc_ene[i] += eacc_ene[i - 1]
+
+
+if njit is not None:
+    _accumulate_kernel = njit(cache=True, fastmath=True)(_accumulate_kernel)
+
 
 def accumulated_particle_info(ene, f):
     """
@@ -48,21 +102,49 @@ def accumulated_particle_info(ene, f):
         eacc_ene: the accumulated particle total energy with energy.
     """
     nbins, = f.shape
-    dlogE = (math.log10(max(ene)) - math.log10(min(ene))) / nbins
-    nacc_ene = np.zeros(nbins)
-    eacc_ene = np.zeros(nbins)
-    nacc_ene[0] = f[0] * ene[0]
-    eacc_ene[0] = 0.5 * f[0] * ene[0]**2
-    for i in range(1, nbins):
-        nacc_ene[i] = f[i] * (ene[i] + ene[i - 1]) * 0.5 + nacc_ene[i - 1]
-        eacc_ene[i] = 0.5 * f[i] * (ene[i] - ene[i - 1]) * (
-            ene[i] + ene[i - 1])
-        eacc_ene[i] += eacc_ene[i - 1]
+    dlogE = (math.log10(ene.max()) - math.log10(ene.min())) / nbins
+    nacc_ene = np.empty(nbins)
+    eacc_ene = np.empty(nbins)
+    if njit is not None:
+        _accumulate_kernel(ene, f, nacc_ene, eacc_ene)
+    else:
+        nacc_ene[0] = f[0] * ene[0]
+        eacc_ene[0] = 0.5 * f[0] * ene[0]**2
+        ene_sum = ene[1:] + ene[:-1]
+        nacc_ene[1:] = f[1:] * ene_sum * 0.5
+        eacc_ene[1:] = 0.5 * f[1:] * (ene[1:] - ene[:-1]) * ene_sum
+        np.cumsum(nacc_ene, out=nacc_ene)
+        np.cumsum(eacc_ene, out=eacc_ene)
     nacc_ene *= dlogE
     eacc_ene *= dlogE
     return (nacc_ene, eacc_ene)
 
 
+def accumulated_particle_total(ene, *fs):
+    """
+    Get the total particle number and total energy from distribution
+    functions sharing the same energy bins. They are the last elements of
+    the arrays from accumulated_particle_info.
+
+    Args:
+        ene: the energy bins array.
+        fs: the energy distribution arrays.
+    Returns:
+        ntot: the total particle number of each distribution.
+        etot: the total particle energy of each distribution.
+    """
+    nbins, = ene.shape
+    dlogE = (math.log10(ene.max()) - math.log10(ene.min())) / nbins
+    ene_sum = ene[1:] + ene[:-1]
+    weights = np.empty((nbins, 2))
+    weights[0, 0] = ene[0]
+    weights[0, 1] = 0.5 * ene[0]**2
+    weights[1:, 0] = ene_sum * 0.5
+    weights[1:, 1] = 0.5 * (ene[1:] - ene[:-1]) * ene_sum
+    totals = np.dot(fs, weights) * dlogE
+    return (totals[:, 0], totals[:, 1])
+
+
 def get_thermal_total(ene, f, fthermal, fnorm):
     """Get total and thermal particle number and energy.
 
@@ -94,7 +176,117 @@ def get_thermal_total(ene, f, fthermal, fnorm):
     return (nthermal, ntot, ethermal, etot)
 
 
-def fit_thermal_core(ene, f):
+def _maxwellian_residual_kernel(a, b, ene, f, sqrt_ene, res):
+    """Fill the residual of the Maxwellian fitting in one pass.
+    """
+    for i in range(ene.shape[0]):
+        res[i] = a * sqrt_ene[i] * math.exp(-b * ene[i]) - f[i]
+
+
+def _maxwellian_jacobian_kernel(a, b, ene, sqrt_ene, jac):
+    """Fill the Jacobian of the Maxwellian fitting in one pass.
+    """
+    for i in range(ene.shape[0]):
+        jac[0, i] = sqrt_ene[i] * math.exp(-b * ene[i])
+        jac[1, i] = -a * ene[i] * jac[0, i]
+
+
+if njit is not None:
+    _maxwellian_residual_kernel = njit(
+        cache=True, fastmath=True)(_maxwellian_residual_kernel)
+    _maxwellian_jacobian_kernel = njit(
+        cache=True, fastmath=True)(_maxwellian_jacobian_kernel)
+
+
+def maxwellian_residual(params, ene, f, sqrt_ene, res, jac):
+    """Residual of the Maxwellian fitting for leastsq.
+
+    The residual is computed in place in res.
+
+    Args:
+        params: the fitting parameters of func_maxwellian.
+        ene: the energy bins array.
+        f: the particle flux distribution.
+        sqrt_ene: np.sqrt(ene).
+        res: the buffer for the residual.
+        jac: the buffer for the Jacobian, not used here.
+    """
+    if njit is not None:
+        _maxwellian_residual_kernel(params[0], params[1], ene, f, sqrt_ene,
+                                    res)
+    else:
+        np.multiply(ene, -params[1], out=res)
+        np.exp(res, out=res)
+        res *= sqrt_ene
+        res *= params[0]
+        res -= f
+    return res
+
+
+def maxwellian_jacobian(params, ene, f, sqrt_ene, res, jac):
+    """Jacobian of maxwellian_residual for leastsq with col_deriv.
+
+    The Jacobian is computed in place in jac, one row for each parameter.
+
+    Args:
+        params: the fitting parameters of func_maxwellian.
+        ene: the energy bins array.
+        f: the particle flux distribution.
+        sqrt_ene: np.sqrt(ene).
+        res: the buffer for the residual, not used here.
+        jac: the buffer for the Jacobian.
+    """
+    if njit is not None:
+        _maxwellian_jacobian_kernel(params[0], params[1], ene, sqrt_ene, jac)
+    else:
+        np.multiply(ene, -params[1], out=jac[0])
+        np.exp(jac[0], out=jac[0])
+        jac[0] *= sqrt_ene
+        np.multiply(ene, -params[0], out=jac[1])
+        jac[1] *= jac[0]
+    return jac
+
+
+def maxwellian_fit(ene, f, p0):
+    """Fit func_maxwellian to the particle distribution.
+
+    The buffers of the residual and the Jacobian are allocated once and
+    reused in every iteration of leastsq.
+
+    Args:
+        ene: the energy bins array.
+        f: the particle flux distribution.
+        p0: initial guess of the fitting parameters.
+
+    Returns:
+        popt: the fitting parameters of func_maxwellian.
+    """
+    ene = np.ascontiguousarray(ene, dtype=np.float64)
+    f = np.ascontiguousarray(f, dtype=np.float64)
+    res = np.empty_like(ene)
+    jac = np.empty((2, ene.size))
+    popt, ier = leastsq(maxwellian_residual, p0,
+                        args=(ene, f, np.sqrt(ene), res, jac),
+                        Dfun=maxwellian_jacobian, col_deriv=True)
+    return popt
+
+
+def maxwellian_guess(ene_peak, f_peak):
+    """Initial guess of the Maxwellian fitting parameters.
+
+    func_maxwellian peaks at 0.5 / b with a peak value of
+    a * sqrt(0.5 / b) * exp(-0.5).
+
+    Args:
+        ene_peak: the energy with the maximum flux.
+        f_peak: the maximum flux.
+    """
+    b = 0.5 / ene_peak
+    a = f_peak * math.exp(0.5) / math.sqrt(ene_peak)
+    return [a, b]
+
+
+def fit_thermal_core(ene, f, verbose=False):
     """Fit to get the thermal core of the particle distribution.
 
     Fit the thermal core of the particle distribution.
@@ -103,29 +295,42 @@ def fit_thermal_core(ene, f):
     Args:
         ene: the energy bins array.
         f: the particle flux distribution.
+        verbose: whether to print the fitting information.
 
     Returns:
         fthermal: thermal part of the particle distribution.
     """
-    print 'Fitting to get the thermal core of the particle distribution.'
+    if verbose:
+        print 'Fitting to get the thermal core of the particle distribution.'
     estart = 0
     ng = 3
-    kernel = np.ones(ng) / float(ng)
-    fnew = np.convolve(f, kernel, 'same')
+    fnew = uniform_filter1d(f, size=ng, mode='constant')
     nshift = 10  # grids shift for fitting thermal core.
-    eend = np.argmax(fnew) + nshift
-    popt, pcov = curve_fit(fitting_funcs.func_maxwellian, ene[estart:eend],
-                           f[estart:eend])
+    ipeak = np.argmax(fnew)
+    eend = ipeak + nshift
+    p0 = maxwellian_guess(ene[ipeak], fnew[ipeak])
+    popt = maxwellian_fit(ene[estart:eend], f[estart:eend], p0)
     fthermal = fitting_funcs.func_maxwellian(ene, popt[0], popt[1])
-    print 'Energy with maximum flux: ', ene[eend - 10]
-    print 'Energy with maximum flux in fitted thermal core: ', 0.5 / popt[1]
-    print 'Thermal core fitting coefficients: '
-    print popt
-    print '---------------------------------------------------------------'
+    if verbose:
+        print 'Energy with maximum flux: ', ene[eend - 10]
+        print 'Energy with maximum flux in fitted thermal core: ', \
+            0.5 / popt[1]
+        print 'Thermal core fitting coefficients: '
+        print popt
+        print '---------------------------------------------------------------'
     return fthermal
 
 
-def background_thermal_core(ene, f, vth, mime):
+def thermal_energy(vth):
+    """Get the thermal energy (gamma - 1) from the thermal speed.
+
+    Args:
+        vth: thermal speed.
+    """
+    return 1.0 / math.sqrt(1.0 - 3.0 * vth**2) - 1.0
+
+
+def background_thermal_core(ene, f, vth, mime, verbose=False):
     """Fit background thermal core.
 
     Fit the background thermal core of the particle distribution. The
@@ -138,23 +343,26 @@ def background_thermal_core(ene, f, vth, mime):
         f: the particle flux distribution.
         vth: thermal speed.
         mime: mass ratio
+        verbose: whether to print the fitting information.
 
     Returns:
         fthermal: thermal part of the particle distribution.
     """
-    print('Fitting background thermal core')
-    gama = 1.0 / math.sqrt(1.0 - 3.0 * vth**2)
-    thermalEnergy = (gama - 1) * mime
+    if verbose:
+        print('Fitting background thermal core')
+    thermalEnergy = thermal_energy(vth) * mime
     fthermal = fitting_funcs.func_maxwellian(ene, 1.0, 1.5 / thermalEnergy)
-    nanMinIndex = np.nanargmin(f / fthermal)
-    tindex = np.argmin(f[:nanMinIndex] / fthermal[:nanMinIndex])
+    ratio = f / fthermal
+    nanMinIndex = np.nanargmin(ratio)
+    tindex = np.argmin(ratio[:nanMinIndex])
     fthermal *= f[tindex] / fthermal[tindex]
     #fthermal *= f[0]/fthermal[0]
-    print('---------------------------------------------------------------')
+    if verbose:
+        print('---------------------------------------------------------------')
     return fthermal
 
 
-def lower_thermal_core(ene, f):
+def lower_thermal_core(ene, f, verbose=False):
     """Fit the thermal core with lower particle energy.
 
     Fit the thermal core with lower energy, which is not supposed to be
@@ -164,26 +372,31 @@ def lower_thermal_core(ene, f):
         ene: the energy bins array.
         f: the particle flux distribution, which is the original particle
             distribution subtracted by the background plasma.
+        verbose: whether to print the fitting information.
 
     Returns:
         fthermal: thermal part of the particle distribution f.
     """
-    print('Fitting lower energy thermal core...')
+    if verbose:
+        print('Fitting lower energy thermal core...')
     estart = 0
     eend = np.argmax(f)
     emin = np.argmin(f[:eend])
-    popt, pcov = curve_fit(fitting_funcs.func_maxwellian, ene[estart:emin],
-                           f[estart:emin])
+    ipeak = np.argmax(f[:emin])
+    p0 = maxwellian_guess(ene[ipeak], f[ipeak])
+    popt = maxwellian_fit(ene[estart:emin], f[estart:emin], p0)
     fthermal = fitting_funcs.func_maxwellian(ene, popt[0], popt[1])
     fthermal[:emin] += f[:emin] - fthermal[:emin]
     fthermal[emin:] = 0.0
-    print 'Lower thermal core fitting coefficients: '
-    print popt
-    print('---------------------------------------------------------------')
+    if verbose:
+        print 'Lower thermal core fitting coefficients: '
+        print popt
+        print('---------------------------------------------------------------')
     return fthermal
 
 
-def fit_nonthermal_power_law(ene, f, fthermal, species, eshift, erange):
+def fit_nonthermal_power_law(ene, f, fthermal, species, eshift, erange,
+                             log_ene=None, verbose=False):
     """Power-law fitting for nonthermal particles.
 
     Using a linear function to fit for reducing fitting error.
@@ -196,6 +409,8 @@ def fit_nonthermal_power_law(ene, f, fthermal, species, eshift, erange):
         species: particle species. 'e' for electron, 'h' for ion.
         eshift: the shift from the maximum of the nonthermal distribution.
         erange: the energy bins of the part for fitting.
+        log_ene: np.log10(ene) if it is already computed.
+        verbose: whether to print the fitting information.
 
     Returns:
         fpowerlaw: the power-law fitting of the non-thermal part of the
@@ -203,46 +418,56 @@ def fit_nonthermal_power_law(ene, f, fthermal, species, eshift, erange):
         e_start, e_end: the starting and ending energy bin index for fitting.
         popt: the fitting parameters.
     """
+    if log_ene is None:
+        log_ene = np.log10(ene)
     fnonthermal = f - fthermal
     estart = np.argmax(fnonthermal) + eshift
     eend = estart + erange
-    popt, pcov = curve_fit(fitting_funcs.func_line,
-                           np.log10(ene[estart:eend]),
-                           np.log10(fnonthermal[estart:eend]))
-    print 'Starting and ending energies for fitting: ', ene[estart], ene[eend]
-    print '---------------------------------------------------------------'
-    fpowerlaw = fitting_funcs.func_line(np.log10(ene), popt[0], popt[1])
+    popt = np.polyfit(log_ene[estart:eend],
+                      np.log10(fnonthermal[estart:eend]), 1)
+    if verbose:
+        print 'Starting and ending energies for fitting: ', ene[estart], \
+            ene[eend]
+        print '---------------------------------------------------------------'
+    fpowerlaw = fitting_funcs.func_line(log_ene, popt[0], popt[1])
     fpowerlaw = np.power(10, fpowerlaw)
     return (fpowerlaw, estart, eend, popt)
 
 
-def fit_powerlaw_whole(ene, f, species):
+def fit_powerlaw_whole(ene, f, species, log_ene=None, verbose=False):
     """Power-law fitting for the high energy part of the whole spectrum.
 
     Args:
         ene: the energy bins array.
         f: the particle flux array.
         species: particle species. 'e' for electron, 'h' for ion.
+        log_ene: np.log10(ene) if it is already computed.
+        verbose: whether to print the fitting information.
 
     Returns:
         fpower: the power-law fitting of the non-thermal part of the
             particle distribution.
     """
-    estart = np.argmax(f) + 50
-    print "Energy bin index with maximum flux: ", np.argmax(f)
+    if log_ene is None:
+        log_ene = np.log10(ene)
+    imax = np.argmax(f)
+    estart = imax + 50
+    if verbose:
+        print "Energy bin index with maximum flux: ", imax
     if (species == 'e'):
         power_range = 90  # for electrons
     else:
         power_range = 130  # for ions
     eend = estart + power_range
-    popt, pcov = curve_fit(fitting_funcs.func_line,
-                           np.log10(ene[estart:eend]),
-                           np.log10(f[estart:eend]))
-    print 'Starting and ending energies for fitting: ', ene[estart], ene[eend]
-    print 'Power-law fitting coefficients for all particles: '
-    print popt
-    print '---------------------------------------------------------------'
-    fpower = fitting_funcs.func_line(np.log10(ene), popt[0], popt[1])
+    popt = np.polyfit(log_ene[estart:eend],
+                      np.log10(f[estart:eend]), 1)
+    if verbose:
+        print 'Starting and ending energies for fitting: ', ene[estart], \
+            ene[eend]
+        print 'Power-law fitting coefficients for all particles: '
+        print popt
+        print '---------------------------------------------------------------'
+    fpower = fitting_funcs.func_line(log_ene, popt[0], popt[1])
     fpower = np.power(10, fpower)
     npower, epower = accumulated_particle_info(ene[estart:eend],
                                                fpower[estart:eend])
@@ -252,29 +477,59 @@ def fit_powerlaw_whole(ene, f, species):
     return (fpower, estart, eend, popt, nportion, eportion)
 
 
-def plot_spectrum(ct, species, ax, pic_info, **kwargs):
-    """Plotting the energy spectrum.
+def spectrum_thermal_fits(ct, species, pic_info, fpath, data=None):
+    """Read the energy spectrum and fit its thermal cores.
+
     Args:
         ct: the time point index.
         species: particle species. 'e' for electron, 'h' for ion.
         pic_info: namedtuple for the PIC simulation information.
-        ax: axes object for the plot.
+        fpath: file path that has the particle spectra data.
+        data: the data already read from the spectrum file, if any.
+
+    Returns:
+        elog: logarithm scale energy bins.
+        flog: particle flux corresponding to elog.
+        fthermal, fnonthermal: the thermal core and the rest of flog.
+        fthermal1: the thermal core fitted to fnonthermal.
+        None is returned if the spectrum data file doesn't exist.
     """
-    if "fpath" in kwargs:
-        fpath = kwargs["fpath"]
-    else:
-        fpath = '../spectrum/'
     fname = fpath + "spectrum-" + species + "." + str(ct)
     fnorm = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-    if (os.path.isfile(fname)):
+    if data is not None:
+        elin, flin, elog, flog = get_energy_distribution(fname, fnorm,
+                                                         data=data)
+    elif (os.path.isfile(fname)):
         elin, flin, elog, flog = get_energy_distribution(fname, fnorm)
     else:
         print "ERROR: the spectrum data file doesn't exist."
-        return
+        return None
     # Ions have lower Lorentz factor due to higher mass
     if (species == 'h'):
         flog /= pic_info.mime
-    elog_norm = get_normalized_energy(species, elog, pic_info)
+    fthermal = fit_thermal_core(elog, flog)
+    fnonthermal = flog - fthermal
+    fthermal1 = fit_thermal_core(elog, fnonthermal)
+    get_thermal_total(elog, flog, fthermal, fnorm)
+    return (elog, flog, fthermal, fnonthermal, fthermal1)
+
+
+def plot_spectrum(ct, species, ax, pic_info, **kwargs):
+    """Plotting the energy spectrum.
+    Args:
+        ct: the time point index.
+        species: particle species. 'e' for electron, 'h' for ion.
+        pic_info: namedtuple for the PIC simulation information.
+        ax: axes object for the plot.
+    """
+    if "fpath" in kwargs:
+        fpath = kwargs["fpath"]
+    else:
+        fpath = '../spectrum/'
+    spect = spectrum_thermal_fits(ct, species, pic_info, fpath)
+    if spect is None:
+        return
+    elog, flog, fthermal, fnonthermal, fthermal1 = spect
     ps = []
     p1, = ax.loglog(elog, flog, linewidth=2)
     if "color" in kwargs:
@@ -282,11 +537,6 @@ def plot_spectrum(ct, species, ax, pic_info, **kwargs):
     ps.append(p1)
 
     color = p1.get_color()
-    fthermal = fit_thermal_core(elog, flog)
-    fnonthermal = flog - fthermal
-    fthermal1 = fit_thermal_core(elog, fnonthermal)
-    fnonthermal1 = fnonthermal - fthermal1
-    get_thermal_total(elog, flog, fthermal, fnorm)
     ax.loglog(
         elog,
         fthermal1,
@@ -331,9 +581,12 @@ def plot_spectrum(ct, species, ax, pic_info, **kwargs):
         pname = '$\sim E^{' + powerIndex + '}$'
         es -= e_extend
         ee += e_extend
+        sl = slice(max(es, 0), min(ee, fpower.size))
+        elog_norm = get_normalized_energy(species, elog, pic_info)
+        elog_plot, fpower_plot = elog_norm[sl], fpower[sl] * 2
         p3, = ax.loglog(
-            elog_norm[es:ee],
-            fpower[es:ee] * 2,
+            elog_plot,
+            fpower_plot,
             color=color,
             linestyle='--',
             linewidth=2,
@@ -372,32 +625,38 @@ def plot_powerlaw_whole(ene, fpower_whole, es, ee, popt, color):
     plt.text(30, 8, pname, color=color, rotation=-0, fontsize=20)
 
 
-def get_normalized_energy(species, ene_bins, pic_info):
+def get_normalized_energy(species, ene_bins, pic_info, verbose=False):
     """Normalize the energies to the initial thermal energy
 
     Args:
         species: particle species. 'e' for electron, 'h' for ion.
         ene_bins: the energy bins.
+        verbose: whether to print the thermal speed.
     """
     if (species == 'e'):
         vth = pic_info.vthe
     else:
         vth = pic_info.vthi
-    print vth
-    gama = 1.0 / math.sqrt(1.0 - 3.0 * vth**2)
-    eth = gama - 1.0
+    if verbose:
+        print vth
+    eth = thermal_energy(vth)
     ene_bins_norm = ene_bins / eth
     return ene_bins_norm
 
 
-def get_energy_distribution(fname, fnorm):
+def get_energy_distribution(fname, fnorm, verbose=False, tframe=None,
+                            data=None):
     """ Get energy bins and corresponding particle flux.
 
     Get linear and logarithm energy bins and particle flux.
 
     Args:
-        fname: file name.
+        fname: file name, or the spectra dataset of one species in the
+            HDF5 file written by save_spectra_h5.
         fnorm: normalization for the distribution.
+        verbose: whether to print the particle number and normalization.
+        tframe: the index of the time frame in the spectra dataset.
+        data: the data already read from fname by read_spectrum_data.
 
     Returns:
         ene_lin: linear scale of energy bins.
@@ -405,18 +664,49 @@ def get_energy_distribution(fname, fnorm):
         flin: particle flux corresponding to ene_lin.
         flog: particle flux corresponding to ene_log.
     """
-    data = read_spectrum_data(fname)
-    ene_lin = data[:, 0]  # Linear scale energy bins
-    flin = data[:, 1]  # Flux using linear energy bins
-    print 'Total number of particles: ', sum(flin)  # Total number of electrons
-    print 'Normalization of the energy distribution: ', fnorm
-
-    ene_log = data[:, 2]  # Logarithm scale energy bins
-    flog = data[:, 3]  # Flux using Logarithm scale bins
+    if data is not None:
+        pass
+    elif tframe is None:
+        data = read_spectrum_data(fname)
+    else:
+        data = fname[tframe]
+    data = np.ascontiguousarray(data.T)
+    ene_lin = data[0]  # Linear scale energy bins
+    flin = data[1]  # Flux using linear energy bins
+    if verbose:
+        # Total number of electrons
+        print 'Total number of particles: ', flin.sum()
+        print 'Normalization of the energy distribution: ', fnorm
+
+    ene_log = data[2]  # Logarithm scale energy bins
+    flog = data[3]  # Flux using Logarithm scale bins
     flog /= fnorm  # Normalized by the maximum value.
     return (ene_lin, flin, ene_log, flog)
 
 
+def get_energy_distribution_cached(fname, fnorm):
+    """Get energy bins and particle flux, caching the results in memory.
+
+    The same spectrum file is read by several plotting functions. The
+    results are cached for each (fname, fnorm) until the file is modified,
+    and copies are returned because callers rescale flog in place.
+
+    Args:
+        fname: file name.
+        fnorm: normalization for the distribution.
+
+    Returns:
+        the same as get_energy_distribution.
+    """
+    key = (fname, fnorm)
+    mtime = os.path.getmtime(fname)
+    if key not in energy_distribution_cache or \
+            energy_distribution_cache[key][0] != mtime:
+        energy_distribution_cache[key] = (
+            mtime, get_energy_distribution(fname, fnorm))
+    return tuple(data.copy() for data in energy_distribution_cache[key][1])
+
+
 def plot_spectrum_bulk(ntp, species, pic_info):
     """Plot a series of energy spectra at bulk energy decay time.
 
@@ -434,8 +724,7 @@ def plot_spectrum_bulk(ntp, species, pic_info):
         vth = pic_info.vthe
     else:
         vth = pic_info.vthi
-    gama = 1.0 / math.sqrt(1.0 - 3 * vth**2)
-    eth = gama - 1.0
+    eth = thermal_energy(vth)
     fname = "../spectrum/whole/spectrum-" + species + \
             "." + str(1).zfill(len(str(1)))
     nx = pic_info.nx
@@ -459,10 +748,10 @@ def plot_spectrum_bulk(ntp, species, pic_info):
     ax.set_ylabel('$f(E)/N_0$', fontdict=font)
     ax.tick_params(labelsize=20)
     plt.tight_layout()
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
+    mkdir_p('../img/')
     fig.savefig('../img/spect_time.eps')
-    plt.show()
+    if show_plots:
+        plt.show()
 
 
 def plot_spectrum_bulk(ntp, species, pic_info):
@@ -499,17 +788,23 @@ def plot_spectrum_bulk(ntp, species, pic_info):
     ax.set_ylabel('$f(E)$', fontdict=font)
     ax.tick_params(labelsize=20)
     plt.tight_layout()
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
+    mkdir_p('../img/')
     fname = 'spect_time_bulk_' + species + '.eps'
     fig.savefig('../img/' + fname)
-    plt.show()
+    if show_plots:
+        plt.show()
 
 
 def read_spectrum_data(fname):
     """Read particle energy spectrum data.
 
     Read particle energy spectrum data at time point it from file.
+    The parsed data is cached column by column in fname + '.columns.npy',
+    which is reused as long as it is not older than the spectrum file.
+    It is written to a temporary file first and renamed, so an interrupted
+    write never leaves a truncated cache. The cache is memory-mapped
+    copy-on-write, so the returned data can be modified without changing
+    the file.
 
     Args:
         fname: the file name of the energy spectrum.
@@ -523,11 +818,182 @@ def read_spectrum_data(fname):
     except IOError:
         print "cannot open ", fname
     else:
-        data = np.genfromtxt(f, delimiter='')
+        fcache = fname + '.columns.npy'
+        if (os.path.isfile(fcache) and
+                os.path.getmtime(fcache) >= os.path.getmtime(fname)):
+            data = np.load(fcache, mmap_mode='c').T
+        else:
+            data = np.loadtxt(f)
+            ftmp = fcache + '.' + str(os.getpid()) + '.tmp'
+            try:
+                with open(ftmp, 'wb') as fh:
+                    np.save(fh, np.ascontiguousarray(data.T))
+                os.rename(ftmp, fcache)
+            except (IOError, OSError):
+                if os.path.isfile(ftmp):
+                    os.remove(ftmp)
         f.close()
         return data
 
 
+def get_run_pic_info(run_name):
+    """Get the PIC simulation information of a run.
+
+    The information is read from ../data/pic_info/ and cached, so each JSON
+    file is parsed only once.
+
+    Args:
+        run_name: the name of the PIC run.
+
+    Returns:
+        pic_info: namedtuple for the PIC simulation information.
+    """
+    if run_name not in pic_info_cache:
+        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
+        pic_info_cache[run_name] = read_data_from_json(picinfo_fname)
+    return pic_info_cache[run_name]
+
+
+def list_spectrum_frames(fdir, species):
+    """List the time frames of the particle energy spectrum files.
+
+    The directory is listed once instead of checking the files one by one.
+    The result is cached until the modification time of fdir changes.
+
+    Args:
+        fdir: the directory that contains the particle spectra data.
+        species: particle species. 'e' for electron, 'h' for ion.
+
+    Returns:
+        tframes: sorted time frame indices of the spectrum files.
+    """
+    if not os.path.isdir(fdir):
+        return []
+    mtime = os.stat(fdir).st_mtime
+    key = (fdir, species)
+    if key in spectrum_frames_cache:
+        cache_mtime, tframes = spectrum_frames_cache[key]
+        if cache_mtime == mtime:
+            return list(tframes)
+    fhead = 'spectrum-' + species + '.'
+    tframes = []
+    for fname in glob.glob(fdir + fhead + '*'):
+        tframe = os.path.basename(fname)[len(fhead):]
+        if tframe.isdigit():
+            tframes.append(int(tframe))
+    tframes.sort()
+    spectrum_frames_cache[key] = (mtime, tframes)
+    return list(tframes)
+
+
+def last_spectrum_file(fdir, species):
+    """Get the file name of the last particle energy spectrum.
+
+    Args:
+        fdir: the directory that contains the particle spectra data.
+        species: particle species. 'e' for electron, 'h' for ion.
+
+    Returns:
+        fname: the spectrum file of the last time frame.
+    """
+    ct = list_spectrum_frames(fdir, species)[-1]
+    return '%sspectrum-%s.%d' % (fdir, species, ct)
+
+
+def read_spectrum_files(fdir, species, tframes):
+    """Read the particle energy spectrum files of some time frames.
+
+    Args:
+        fdir: the directory that contains the particle spectra data.
+        species: particle species. 'e' for electron, 'h' for ion.
+        tframes: the time frames to read.
+
+    Returns:
+        spectra: the spectra with shape (nframes, nbins, 4). Each row is the
+            data of read_spectrum_data for the time frame in tframes.
+    """
+    spectra = np.empty((0, 0, 4))
+    for i, ct in enumerate(tframes):
+        data = read_spectrum_data('%sspectrum-%s.%d' % (fdir, species, ct))
+        if i == 0:
+            spectra = np.empty((len(tframes), ) + data.shape)
+        spectra[i] = data
+    return spectra
+
+
+def spectrum_files_mtime(fdir, species, tframes):
+    """Get the latest modification time of the spectrum files.
+
+    Args:
+        fdir: the directory that contains the particle spectra data.
+        species: particle species. 'e' for electron, 'h' for ion.
+        tframes: the time frames of the spectrum files.
+
+    Returns:
+        mtime: the latest modification time, or 0 if there are no files.
+    """
+    return max([0] + [
+        os.path.getmtime('%sspectrum-%s.%d' % (fdir, species, ct))
+        for ct in tframes
+    ])
+
+
+def write_spectra_group(fh, species, tframes, spectra, mtime):
+    """Write the spectra of one species into an HDF5 file.
+
+    Args:
+        fh: the HDF5 file opened for writing.
+        species: particle species. 'e' for electron, 'h' for ion.
+        tframes: the time frame of each row of spectra.
+        spectra: the spectra with shape (nframes, nbins, 4).
+        mtime: the latest modification time of the spectrum files, taken
+            before they are read.
+    """
+    if species in fh:
+        del fh[species]
+    nframes, nbins, nvar = spectra.shape
+    group = fh.create_group(species)
+    group.create_dataset('spectra', data=spectra,
+                         chunks=(1, nbins, nvar),
+                         compression='lzf')
+    group.create_dataset('tframes', data=np.array(tframes))
+    group.attrs['mtime'] = mtime
+
+
+def read_spectrum_cube(fdir, species):
+    """Read all the particle energy spectra of one species in a run.
+
+    The spectra are read from the HDF5 file written by save_spectra_h5 next
+    to fdir, e.g. ../data/spectra/<run_name>.h5, as long as it has the time
+    frames listed in fdir and none of the spectrum files is newer than it.
+    Otherwise, the spectrum files are read. The HDF5 file is never written
+    here, only by save_spectra_h5.
+
+    Args:
+        fdir: the directory that contains the particle spectra data.
+        species: particle species. 'e' for electron, 'h' for ion.
+
+    Returns:
+        tframes: sorted time frame indices of the spectrum files.
+        cube: the spectra with shape (nframes, nbins, 4). Each row is the
+            data of read_spectrum_data for the time frame in tframes.
+    """
+    tframes = list_spectrum_frames(fdir, species)
+    fname = fdir.rstrip('/') + '.h5'
+    if os.path.isfile(fname):
+        mtime = spectrum_files_mtime(fdir, species, tframes)
+        try:
+            with h5py.File(fname, 'r') as fh:
+                if (species in fh and
+                        fh[species].attrs.get('mtime', -1) >= mtime and
+                        list(fh[species]['tframes'][:]) == tframes):
+                    return tframes, fh[species]['spectra'][:]
+        except (IOError, OSError, KeyError):
+            # Read the spectrum files if the HDF5 file cannot be read
+            pass
+    return tframes, read_spectrum_files(fdir, species, tframes)
+
+
 def maximum_energy_spectra(ntp, species, pic_info, fpath='../spectrum/'):
     """Get the maximum energy from a energy spectra.
 
@@ -540,34 +1006,25 @@ def maximum_energy_spectra(ntp, species, pic_info, fpath='../spectrum/'):
         max_ene: the maximum energy at each time step.
     """
     max_ene = np.zeros(ntp)
-    for ct in range(1, ntp, 1):
-        # Get particle spectra energy bins and flux
-        fname = fpath + "spectrum-" + species + "." + str(ct).zfill(
-            len(str(ct)))
-        nx = pic_info.nx
-        ny = pic_info.ny
-        nz = pic_info.nz
-        nppc = pic_info.nppc
-        if species == 'e':
-            ptl_mass = 1.0
-        else:
-            ptl_mass = pic_info.mime
-        fnorm = nx * ny * nz * nppc * ptl_mass
-        if (os.path.isfile(fname)):
-            ene_lin, flin, ene_log, flog = get_energy_distribution(fname,
-                                                                   fnorm)
-        else:
-            print "ERROR: the spectrum data file doesn't exist."
-            return
-        ene_log_norm = get_normalized_energy(species, ene_log, pic_info)
-        max_ene[ct] = ene_log[np.max(np.nonzero(flog))]
+    tframes, cube = read_spectrum_cube(fpath, species)
+    if not set(range(1, ntp)).issubset(tframes):
+        print "ERROR: the spectrum data file doesn't exist."
+        return
+
+    if ntp > 1:
+        # Index of the last nonzero flux bin at each time frame
+        rows = np.searchsorted(tframes, np.arange(1, ntp))
+        nonzero = cube[rows, :, 3] != 0
+        nbins = nonzero.shape[1]
+        imax = nbins - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+        # The maximum energy of an empty spectrum is 0
+        max_ene[1:] = np.where(nonzero.any(axis=1), cube[rows, imax, 2], 0)
 
     if (species == 'e'):
         vth = pic_info.vthe
     else:
         vth = pic_info.vthi
-    gama = 1.0 / math.sqrt(1.0 - 3 * vth**2)
-    eth = gama - 1.0
+    eth = thermal_energy(vth)
 
     return max_ene / eth
 
@@ -590,23 +1047,30 @@ def maximum_energy_particle(species, pic_info, fpath='../spectrum/'):
         vth = pic_info.vthe
     else:
         vth = pic_info.vthi
-    gama = 1.0 / math.sqrt(1.0 - 3 * vth**2)
-    eth = gama - 1.0
+    eth = thermal_energy(vth)
 
     return max_ene / eth
 
 
-def plot_maximum_energy(pic_info, dir):
+def plot_maximum_energy(pic_info, dir, fig=None):
     """Plot a series of energy spectra.
 
     Args:
         pic_info: namedtuple for the PIC simulation information.
         dir: the directory that contains the particle spectra data.
+        fig: the figure to reuse. It is cleared before plotting. A new
+            figure is created if it is None.
+
+    Returns:
+        fig: the figure of the maximum energies.
     """
     max_ene_e = maximum_energy_particle('e', pic_info, dir)
     max_ene_i = maximum_energy_particle('h', pic_info, dir)
 
-    fig = plt.figure(figsize=[7, 5])
+    if fig is None:
+        fig = plt.figure(figsize=[7, 5])
+    else:
+        fig.clf()
     width = 0.69
     height = 0.8
     xs = 0.16
@@ -636,21 +1100,18 @@ def plot_maximum_energy(pic_info, dir):
     for tl in ax1.get_yticklabels():
         tl.set_color(colors[1])
     # plt.show()
+    return fig
 
 
 def move_energy_spectra():
-    if not os.path.isdir('../data/'):
-        os.makedirs('../data/')
     fdir = '../data/spectra/'
-    if not os.path.isdir(fdir):
-        os.makedirs(fdir)
+    mkdir_p(fdir)
     # base_dirs, run_names = ApJ_long_paper_runs()
     # base_dirs, run_names = guide_field_runs()
     base_dirs, run_names = low_beta_runs()
     for base_dir, run_name in zip(base_dirs, run_names):
         fpath = fdir + run_name
-        if not os.path.isdir(fpath):
-            os.makedirs(fpath)
+        mkdir_p(fpath)
         fname = base_dir + "/pic_analysis/spectrum/*"
         if os.path.isfile(fname):
             command = "cp " + fname + " " + fpath
@@ -659,6 +1120,30 @@ def move_energy_spectra():
             command = "cp " + fname + " " + fpath
 
         os.system(command)
+        save_spectra_h5(fpath + '/', fdir + run_name + '.h5')
+
+
+def save_spectra_h5(fdir, fname):
+    """Save all the particle energy spectra of a run into one HDF5 file.
+
+    For each species, the group <species> contains the dataset "spectra"
+    with shape (nframes, nbins, 4), which can be read back with
+    get_energy_distribution, and the dataset "tframes" with the time frame
+    of each row. Its attribute "mtime" is the latest modification time of
+    the spectrum files, which read_spectrum_cube checks.
+
+    Args:
+        fdir: the directory that contains the particle spectra data.
+        fname: the file name of the HDF5 file.
+    """
+    with h5py.File(fname, 'w') as fh:
+        for species in ['e', 'h']:
+            tframes = list_spectrum_frames(fdir, species)
+            if not tframes:
+                continue
+            mtime = spectrum_files_mtime(fdir, species, tframes)
+            spectra = read_spectrum_files(fdir, species, tframes)
+            write_spectra_group(fh, species, tframes, spectra, mtime)
 
 
 def plot_nonthernal_fraction(nnth, enth, pic_info):
@@ -701,49 +1186,58 @@ def plot_nonthernal_fraction(nnth, enth, pic_info):
         text.set_color(color)
 
 
+def nonthermal_fraction_single(fname, n0):
+    """Calculate nonthermal fraction for a single spectrum file.
+
+    Args:
+        fname: the file name of the energy spectrum.
+        n0: normalization for the distribution.
+
+    Returns:
+        nnth: nonthermal fraction for particle number.
+        enth: nonthermal fraction for particle energy.
+    """
+    elin, flin, elog, flog = get_energy_distribution(fname, n0)
+    fthermal = fit_thermal_core(elog, flog)
+    fnonthermal = flog - fthermal
+    ntot, etot = accumulated_particle_total(elog, flog, fnonthermal)
+    return (ntot[1] / ntot[0], etot[1] / etot[0])
+
+
 def calc_nonthermal_fraction(species):
     """Calculate nonthermal fraction.
 
     Args:
         species: particle species.
     """
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
     img_dir = '../img/nonthermal/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
+    mkdir_p(img_dir)
     # base_dirs, run_names = ApJ_long_paper_runs()
     base_dirs, run_names = guide_field_runs()
     nruns = len(run_names)
     nnth_fraction = []
     enth_fraction = []
+    ncores = multiprocessing.cpu_count()
     for run_name in run_names:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
+        pic_info = get_run_pic_info(run_name)
         dir = '../data/spectra/' + run_name + '/'
         n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        ct = 1
-        fname = dir + 'spectrum-' + species + '.1'
-        file_exist = os.path.isfile(fname)
-        nnth_time = [0]
-        enth_time = [0]
-        while file_exist:
-            elin, flin, elog, flog = get_energy_distribution(fname, n0)
-            ct += 1
-            fname = dir + 'spectrum-' + species + '.' + str(ct)
-            file_exist = os.path.isfile(fname)
-            fthermal = fit_thermal_core(elog, flog)
-            fnonthermal = flog - fthermal
-            ntot, etot = accumulated_particle_info(elog, flog)
-            nnth, enth = accumulated_particle_info(elog, fnonthermal)
-            nnth_time.append(nnth[-1] / ntot[-1])
-            enth_time.append(enth[-1] / etot[-1])
+        fnames = [dir + 'spectrum-' + species + '.' + str(ct)
+                  for ct in list_spectrum_frames(dir, species)]
+        fractions = Parallel(n_jobs=ncores)(
+            delayed(nonthermal_fraction_single)(fname, n0)
+            for fname in fnames)
+        nnth_time = np.zeros(len(fnames) + 1)
+        enth_time = np.zeros(len(fnames) + 1)
+        for ct, (nnth, enth) in enumerate(fractions, 1):
+            nnth_time[ct] = nnth
+            enth_time[ct] = enth
         plot_nonthernal_fraction(nnth_time, enth_time, pic_info)
         fname = img_dir + 'nth_' + run_name + '_' + species + '.eps'
         plt.savefig(fname)
         plt.close()
-        nnth_fraction.append(nnth[-1] / ntot[-1])
-        enth_fraction.append(enth[-1] / etot[-1])
+        nnth_fraction.append(nnth_time[-1])
+        enth_fraction.append(enth_time[-1])
     for i in range(nruns):
         print("%s %5.2f %5.2f" % (run_names[i], nnth_fraction[i],
                                   enth_fraction[i]))
@@ -751,7 +1245,7 @@ def calc_nonthermal_fraction(species):
     return (nnth_fraction, enth_fraction)
 
 
-def power_law_fit(ene, f, offset, extend):
+def power_law_fit(ene, f, offset, extend, log_ene=None, verbose=False):
     """Power-law fitting for the power-law part of the spectrum.
 
     Args:
@@ -760,31 +1254,35 @@ def power_law_fit(ene, f, offset, extend):
         species: particle species. 'e' for electron, 'h' for ion.
         offset: offset energy bins from the energy with the maximum f.
         extend: the extend of the power-law part.
+        log_ene: np.log10(ene) if it is already computed.
+        verbose: whether to print the fitting information.
 
     Returns:
         fpower: the power-law fitting of the non-thermal part of the
             particle distribution.
     """
-    estart = np.argmax(f) + offset
-    print("Energy bin index with maximum flux: %d" % np.argmax(f))
+    if log_ene is None:
+        log_ene = np.log10(ene)
+    imax = np.argmax(f)
+    estart = imax + offset
+    if verbose:
+        print("Energy bin index with maximum flux: %d" % imax)
     eend = estart + extend
-    popt, pcov = curve_fit(fitting_funcs.func_line,
-                           np.log10(ene[estart:eend]),
-                           np.log10(f[estart:eend]))
-    print 'Starting and ending energies for fitting: ', ene[estart], ene[eend]
-    print 'Power-law fitting coefficients for all particles: '
-    print popt
-    print '---------------------------------------------------------------'
-    fpower = fitting_funcs.func_line(np.log10(ene), popt[0], popt[1])
+    popt = np.polyfit(log_ene[estart:eend],
+                      np.log10(f[estart:eend]), 1)
+    if verbose:
+        print 'Starting and ending energies for fitting: ', ene[estart], \
+            ene[eend]
+        print 'Power-law fitting coefficients for all particles: '
+        print popt
+        print '---------------------------------------------------------------'
+    fpower = fitting_funcs.func_line(log_ene, popt[0], popt[1])
     fpower = np.power(10, fpower)
     npower, epower = accumulated_particle_info(ene[estart:eend],
                                                fpower[estart:eend])
     ntot, etot = accumulated_particle_info(ene, f)
     nfraction = npower[-1] / ntot[-1]
     efraction = epower[-1] / etot[-1]
-    power_fitting = collections.namedtuple(
-        "power_fitting",
-        ['fpower', 'es', 'ee', 'params', 'nfraction', 'efraction'])
     power_fit = power_fitting(
         fpower=fpower,
         es=estart,
@@ -795,16 +1293,123 @@ def power_law_fit(ene, f, offset, extend):
     return power_fit
 
 
+def power_law_fit_batch(enes, fs, offsets, extends):
+    """Power-law fitting for the spectra of multiple runs at once.
+
+    The spectra are stacked into 2D arrays, and the linear fittings in log
+    space are solved together with the least-squares normal equations of
+    all the rows. If the runs have different numbers of energy bins, they
+    are fitted one by one with power_law_fit instead.
+
+    Args:
+        enes: the energy bins arrays of the runs.
+        fs: the particle flux arrays of the runs.
+        offsets: offset energy bins from the energy with the maximum f.
+        extends: the extends of the power-law parts.
+
+    Returns:
+        power_fits: a list of the power-law fittings, one for each run, in
+            the same form as the return of power_law_fit.
+    """
+    if len(set(np.shape(data) for data in list(enes) + list(fs))) > 1:
+        return [
+            power_law_fit(ene, f, offset, extend)
+            for ene, f, offset, extend in zip(enes, fs, offsets, extends)
+        ]
+    ene = np.vstack(enes)
+    f = np.vstack(fs)
+    log_ene = np.log10(ene)
+    nbins = f.shape[1]
+    estart = np.argmax(f, axis=1) + np.asarray(offsets)
+    eend = estart + np.asarray(extends)
+    ibins = np.arange(nbins)
+    mask = (ibins >= estart[:, None]) & (ibins < eend[:, None])
+    x = np.where(mask, log_ene, 0.0)
+    y = np.log10(np.where(mask, f, 1.0))
+    npts = mask.sum(axis=1)
+    sx = x.sum(axis=1)
+    sy = y.sum(axis=1)
+    sxx = (x * x).sum(axis=1)
+    sxy = (x * y).sum(axis=1)
+    slope = (npts * sxy - sx * sy) / (npts * sxx - sx * sx)
+    intercept = (sy - slope * sx) / npts
+    fpower = np.power(10, fitting_funcs.func_line(log_ene, slope[:, None],
+                                                  intercept[:, None]))
+    power_fits = []
+    for i in range(f.shape[0]):
+        es, ee = estart[i], eend[i]
+        npower, epower = accumulated_particle_info(ene[i, es:ee],
+                                                   fpower[i, es:ee])
+        ntot, etot = accumulated_particle_total(ene[i], f[i])
+        power_fit = power_fitting(
+            fpower=fpower[i],
+            es=es,
+            ee=ee,
+            params=np.array([slope[i], intercept[i]]),
+            nfraction=npower[-1] / ntot[0],
+            efraction=epower[-1] / etot[0])
+        power_fits.append(power_fit)
+    return power_fits
+
+
+def compute_spectra_panel(run_names, species, shift, offset, extent,
+                          nwhole=0, ng=None):
+    """Compute the spectra and the fittings of the runs in one plot.
+
+    For each run, the last spectrum is read and shifted, and the thermal
+    core is fitted. Then the power-law parts of all the runs are fitted
+    together.
+
+    Args:
+        run_names: the names of the PIC runs.
+        species: particle species. 'e' for electron, 'h' for ion.
+        shift: the factor to shift the spectrum of each run.
+        offset: offset energy bins of the power-law fitting of each run.
+        extent: the extent of the power-law fitting of each run.
+        nwhole: the number of leading runs that have the power-law fitting
+            on the whole spectrum instead of the non-thermal part.
+        ng: the size of the smoothing filter. No smoothing if it is None.
+
+    Returns:
+        elogs_norm: normalized logarithm energy bins of each run.
+        flogs: particle flux of each run.
+        fnonthermals: the non-thermal part of the flux of each run.
+        power_fits: the power-law fitting of each run.
+    """
+    elogs, elogs_norm, flogs, fnonthermals = [], [], [], []
+    for run, run_name in enumerate(run_names):
+        pic_info = get_run_pic_info(run_name)
+        dir = '../data/spectra/' + run_name + '/'
+        n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
+        fname = last_spectrum_file(dir, species)
+        elin, flin, elog, flog = get_energy_distribution_cached(fname, n0)
+        elog_norm = get_normalized_energy(species, elog, pic_info)
+        if ng is None:
+            flog = flog * shift[run]
+        else:
+            fsmooth = uniform_filter1d(flog * shift[run], size=ng,
+                                       mode='constant')
+            # The running sum leaves float residue where the whole window
+            # is zero, e.g. past the cutoff, which np.convolve keeps at 0
+            fsmooth[maximum_filter1d(np.abs(flog), size=ng,
+                                     mode='constant') == 0] = 0
+            flog = fsmooth
+        fthermal = fit_thermal_core(elog, flog)
+        elogs.append(elog)
+        elogs_norm.append(elog_norm)
+        flogs.append(flog)
+        fnonthermals.append(flog - fthermal)
+
+    ffits = flogs[:nwhole] + fnonthermals[nwhole:]
+    power_fits = power_law_fit_batch(elogs, ffits, offset, extent)
+    return (elogs_norm, flogs, fnonthermals, power_fits)
+
+
 def plot_spectra_beta_electron():
     """Plot spectra for multiple runs with different beta.
 
     """
     species = 'e'
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    img_dir = '../img/spectra/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
     fig = plt.figure(figsize=[7, 5])
     xs, ys = 0.15, 0.15
     w1, h1 = 0.8, 0.8
@@ -819,21 +1424,13 @@ def plot_spectra_beta_electron():
     e_extend = 20
     colors_plot = []
     for run_name in run_names[:4]:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
+        pic_info = get_run_pic_info(run_name)
         dir = '../data/spectra/' + run_name + '/'
         n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        ct = 1
-        fname = dir + 'spectrum-' + species + '.1'
-        file_exist = os.path.isfile(fname)
-        while file_exist:
-            ct += 1
-            fname = dir + 'spectrum-' + species + '.' + str(ct)
-            file_exist = os.path.isfile(fname)
-        fname = dir + 'spectrum-' + species + '.' + str(ct - 1)
-        elin, flin, elog, flog = get_energy_distribution(fname, n0)
+        fname = last_spectrum_file(dir, species)
+        elin, flin, elog, flog = get_energy_distribution_cached(fname, n0)
         elog_norm = get_normalized_energy(species, elog, pic_info)
-        flog *= shift
+        flog = flog * shift
         # p1, = ax.loglog(elog_norm, flog, linewidth=2)
         p1, = ax.semilogy(elog_norm, flog, linewidth=2)
         power_fit = power_law_fit(elog, flog, offset[run], extent[run])
@@ -842,12 +1439,14 @@ def plot_spectra_beta_electron():
         color = p1.get_color()
         es -= e_extend
         ee += e_extend
+        sl = slice(max(es, 0), min(ee, fpower.size))
+        elog_plot, fpower_plot = elog_norm[sl], fpower[sl] * 2
         powerIndex = "{%0.2f}" % power_fit.params[0]
         pname = r'$\sim \varepsilon^{' + powerIndex + '}$'
         if run > 0:
             p23, = ax.loglog(
-                elog_norm[es:ee],
-                fpower[es:ee] * 2,
+                elog_plot,
+                fpower_plot,
                 color=color,
                 linestyle='--',
                 linewidth=2,
@@ -880,52 +1479,28 @@ def plot_spectra_beta_electron():
         frameon=False)
     for color, text in zip(colors_plot, leg.get_texts()):
         text.set_color(color)
-    ax.text(
-        0.5,
-        0.05,
-        'R8',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.6,
-        0.05,
-        'R7',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.7,
-        0.05,
-        'R1',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.85,
-        0.05,
-        'R6',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    dir = '../img/spectra/'
-    if not os.path.isdir(dir):
-        os.makedirs(dir)
-    fname = dir + 'spect_beta_electron.eps'
-    fig.savefig(fname, transparent=True)
+    labels = [
+        (0.5, 0.05, 'R8', 0, 0),
+        (0.6, 0.05, 'R7', 1, 0),
+        (0.7, 0.05, 'R1', 2, 0),
+        (0.85, 0.05, 'R6', 3, 0)]
+    for x, y, text, icolor, rotation in labels:
+        ax.text(
+            x,
+            y,
+            text,
+            color=colors[icolor],
+            fontsize=20,
+            rotation=rotation,
+            horizontalalignment='left',
+            verticalalignment='center',
+            transform=ax.transAxes)
 
-    plt.show()
+    fname = img_spectra_dir + 'spect_beta_electron.eps'
+    fig.savefig(fname, transparent=True)
+    if show_plots:
+        plt.show()
+    plt.close(fig)
 
 
 def plot_spectra_beta_electron_fitted():
@@ -933,11 +1508,6 @@ def plot_spectra_beta_electron_fitted():
 
     """
     species = 'e'
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    img_dir = '../img/spectra/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
     fig = plt.figure(figsize=[7, 5])
     xs, ys = 0.15, 0.15
     w1, h1 = 0.8, 0.8
@@ -954,47 +1524,33 @@ def plot_spectra_beta_electron_fitted():
     colors_plot = []
     e_nth = 200
     # run = 3
-    for run_name in run_names[:4]:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
-        dir = '../data/spectra/' + run_name + '/'
-        n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        ct = 1
-        fname = dir + 'spectrum-' + species + '.1'
-        file_exist = os.path.isfile(fname)
-        while file_exist:
-            ct += 1
-            fname = dir + 'spectrum-' + species + '.' + str(ct)
-            file_exist = os.path.isfile(fname)
-        fname = dir + 'spectrum-' + species + '.' + str(ct - 1)
-        elin, flin, elog, flog = get_energy_distribution(fname, n0)
-        elog_norm = get_normalized_energy(species, elog, pic_info)
-        flog *= shift[run]
-        fthermal = fit_thermal_core(elog, flog)
-        fnonthermal = flog - fthermal
+    elogs_norm, flogs, fnonthermals, power_fits = compute_spectra_panel(
+        run_names[:4], species, shift, offset, extent, nwhole=2)
+    for run in range(len(flogs)):
+        elog_norm = elogs_norm[run]
+        flog = flogs[run]
+        fnonthermal = fnonthermals[run]
         p1, = ax.loglog(elog_norm, flog, linewidth=2)
         color = p1.get_color()
         if run > 0:
             p11, = ax.loglog(
                 elog_norm[e_nth:], fnonthermal[e_nth:], color=color)
 
-        if run < 2:
-            power_fit = power_law_fit(elog, flog, offset[run], extent[run])
-        else:
-            power_fit = power_law_fit(elog, fnonthermal, offset[run],
-                                      extent[run])
+        power_fit = power_fits[run]
         # power_fit = power_law_fit(elog, flog, 90, 30)
         # power_fit = power_law_fit(elog, fnonthermal, 35, 70)
         es, ee = power_fit.es, power_fit.ee
         fpower = power_fit.fpower
         es -= e_extend
         ee += e_extend
+        sl = slice(max(es, 0), min(ee, fpower.size))
+        elog_plot, fpower_plot = elog_norm[sl], fpower[sl] * 2
         powerIndex = "{%0.2f}" % power_fit.params[0]
         pname = r'$\sim \varepsilon^{' + powerIndex + '}$'
         if run > 0:
             p23, = ax.loglog(
-                elog_norm[es:ee],
-                fpower[es:ee] * 2,
+                elog_plot,
+                fpower_plot,
                 color=color,
                 linestyle='--',
                 linewidth=2,
@@ -1013,7 +1569,6 @@ def plot_spectra_beta_electron_fitted():
         ax.set_xlim([1E-1, 2E3])
         ax.set_ylim([1E-5, 1E4])
         # shift *= 5
-        run += 1
 
     ax.set_xlabel(
         r'$\varepsilon/\varepsilon_\text{th}$', fontdict=font, fontsize=24)
@@ -1028,92 +1583,32 @@ def plot_spectra_beta_electron_fitted():
         frameon=False)
     for color, text in zip(colors_plot, leg.get_texts()):
         text.set_color(color)
-    ax.text(
-        0.50,
-        0.05,
-        'R8',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.59,
-        0.05,
-        'R7',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.7,
-        0.05,
-        'R1',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.85,
-        0.05,
-        'R6',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.5,
-        0.27,
-        r'$\beta_e=0.2$',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes,
-        rotation=-75)
-    ax.text(
-        0.6,
-        0.25,
-        r'$\beta_e=0.07$',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes,
-        rotation=-75)
-    ax.text(
-        0.7,
-        0.25,
-        r'$\beta_e=0.02$',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes,
-        rotation=-68)
-    ax.text(
-        0.82,
-        0.25,
-        r'$\beta_e=0.007$',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes,
-        rotation=-62)
-
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    dir = '../img/spectra/'
-    if not os.path.isdir(dir):
-        os.makedirs(dir)
-    fname = dir + 'spect_beta_electron_fitted.eps'
-    fig.savefig(fname)
+    labels = [
+        (0.50, 0.05, 'R8', 0, 0),
+        (0.59, 0.05, 'R7', 1, 0),
+        (0.7, 0.05, 'R1', 2, 0),
+        (0.85, 0.05, 'R6', 3, 0),
+        (0.5, 0.27, r'$\beta_e=0.2$', 0, -75),
+        (0.6, 0.25, r'$\beta_e=0.07$', 1, -75),
+        (0.7, 0.25, r'$\beta_e=0.02$', 2, -68),
+        (0.82, 0.25, r'$\beta_e=0.007$', 3, -62)]
+    for x, y, text, icolor, rotation in labels:
+        ax.text(
+            x,
+            y,
+            text,
+            color=colors[icolor],
+            fontsize=20,
+            rotation=rotation,
+            horizontalalignment='left',
+            verticalalignment='center',
+            transform=ax.transAxes)
 
-    plt.show()
+    fname = img_spectra_dir + 'spect_beta_electron_fitted.eps'
+    fig.savefig(fname)
+    if show_plots:
+        plt.show()
+    plt.close(fig)
 
 
 def plot_spectra_multi_electron():
@@ -1121,11 +1616,6 @@ def plot_spectra_multi_electron():
 
     """
     species = 'e'
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    img_dir = '../img/spectra/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
     fig = plt.figure(figsize=[7, 5])
     xs, ys = 0.15, 0.15
     w1, h1 = 0.8, 0.8
@@ -1141,21 +1631,13 @@ def plot_spectra_multi_electron():
     e_extend = 40
     colors_plot = []
     for run_name in run_names[4:8]:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
+        pic_info = get_run_pic_info(run_name)
         dir = '../data/spectra/' + run_name + '/'
         n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        ct = 1
-        fname = dir + 'spectrum-' + species + '.1'
-        file_exist = os.path.isfile(fname)
-        while file_exist:
-            ct += 1
-            fname = dir + 'spectrum-' + species + '.' + str(ct)
-            file_exist = os.path.isfile(fname)
-        fname = dir + 'spectrum-' + species + '.' + str(ct - 1)
-        elin, flin, elog, flog = get_energy_distribution(fname, n0)
+        fname = last_spectrum_file(dir, species)
+        elin, flin, elog, flog = get_energy_distribution_cached(fname, n0)
         elog_norm = get_normalized_energy(species, elog, pic_info)
-        flog *= shift[run]
+        flog = flog * shift[run]
         p1, = ax.loglog(elog_norm, flog, linewidth=2)
         power_fit = power_law_fit(elog, flog, offset[run], extent[run])
         es, ee = power_fit.es, power_fit.ee
@@ -1163,11 +1645,13 @@ def plot_spectra_multi_electron():
         color = p1.get_color()
         es -= e_extend
         ee += e_extend
+        sl = slice(max(es, 0), min(ee, fpower.size))
+        elog_plot, fpower_plot = elog_norm[sl], fpower[sl] * 2
         powerIndex = "{%0.2f}" % power_fit.params[0]
         pname = r'$\sim \varepsilon^{' + powerIndex + '}$'
         p23, = ax.loglog(
-            elog_norm[es:ee],
-            fpower[es:ee] * 2,
+            elog_plot,
+            fpower_plot,
             color=color,
             linestyle='--',
             linewidth=2,
@@ -1207,52 +1691,28 @@ def plot_spectra_multi_electron():
         frameon=False)
     for color, text in zip(colors_plot, leg.get_texts()):
         text.set_color(color)
-    ax.text(
-        0.05,
-        0.66,
-        'R5',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.9,
-        'R3',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.82,
-        'R2',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.76,
-        'R4',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    dir = '../img/spectra/'
-    if not os.path.isdir(dir):
-        os.makedirs(dir)
-    fname = dir + 'spect_multi_electron.eps'
-    fig.savefig(fname)
+    labels = [
+        (0.05, 0.66, 'R5', 0, 0),
+        (0.05, 0.9, 'R3', 1, 0),
+        (0.05, 0.82, 'R2', 2, 0),
+        (0.05, 0.76, 'R4', 3, 0)]
+    for x, y, text, icolor, rotation in labels:
+        ax.text(
+            x,
+            y,
+            text,
+            color=colors[icolor],
+            fontsize=20,
+            rotation=rotation,
+            horizontalalignment='left',
+            verticalalignment='center',
+            transform=ax.transAxes)
 
-    plt.show()
+    fname = img_spectra_dir + 'spect_multi_electron.eps'
+    fig.savefig(fname)
+    if show_plots:
+        plt.show()
+    plt.close(fig)
 
 
 def plot_spectra_multi_electron_fitted():
@@ -1260,11 +1720,6 @@ def plot_spectra_multi_electron_fitted():
 
     """
     species = 'e'
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    img_dir = '../img/spectra/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
     fig = plt.figure(figsize=[7, 5])
     xs, ys = 0.15, 0.15
     w1, h1 = 0.8, 0.8
@@ -1281,41 +1736,29 @@ def plot_spectra_multi_electron_fitted():
     colors_plot = []
     e_nth = [400, 300, 350, 400]
     ng = 3
-    kernel = np.ones(ng) / float(ng)
-    for run_name in run_names[4:8]:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
-        dir = '../data/spectra/' + run_name + '/'
-        n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        ct = 1
-        fname = dir + 'spectrum-' + species + '.1'
-        file_exist = os.path.isfile(fname)
-        while file_exist:
-            ct += 1
-            fname = dir + 'spectrum-' + species + '.' + str(ct)
-            file_exist = os.path.isfile(fname)
-        fname = dir + 'spectrum-' + species + '.' + str(ct - 1)
-        elin, flin, elog, flog = get_energy_distribution(fname, n0)
-        elog_norm = get_normalized_energy(species, elog, pic_info)
-        flog *= shift[run]
-        flog = np.convolve(flog, kernel, 'same')
-        fthermal = fit_thermal_core(elog, flog)
-        fnonthermal = flog - fthermal
+    elogs_norm, flogs, fnonthermals, power_fits = compute_spectra_panel(
+        run_names[4:8], species, shift, offset, extent, ng=ng)
+    for run in range(len(flogs)):
+        elog_norm = elogs_norm[run]
+        flog = flogs[run]
+        fnonthermal = fnonthermals[run]
         p1, = ax.loglog(elog_norm, flog, linewidth=2)
         color = p1.get_color()
         p11, = ax.loglog(
             elog_norm[e_nth[run]:], fnonthermal[e_nth[run]:], color=color)
         # power_fit = power_law_fit(elog, fnonthermal, 310, 50)
-        power_fit = power_law_fit(elog, fnonthermal, offset[run], extent[run])
+        power_fit = power_fits[run]
         es, ee = power_fit.es, power_fit.ee
         fpower = power_fit.fpower
         powerIndex = "{%0.2f}" % power_fit.params[0]
         pname = r'$\sim \varepsilon^{' + powerIndex + '}$'
         es -= e_extend
         ee += e_extend
+        sl = slice(max(es, 0), min(ee, fpower.size))
+        elog_plot, fpower_plot = elog_norm[sl], fpower[sl] * 2
         p23, = ax.loglog(
-            elog_norm[es:ee],
-            fpower[es:ee] * 2,
+            elog_plot,
+            fpower_plot,
             color=color,
             linestyle='--',
             linewidth=2,
@@ -1331,7 +1774,6 @@ def plot_spectra_multi_electron_fitted():
         ax.set_xlim([1E-1, 3E2])
         ax.set_ylim([1E-5, 4E4])
         # shift *= 5
-        run += 1
 
     ax.set_xlabel(
         r'$\varepsilon/\varepsilon_\text{th}$', fontdict=font, fontsize=24)
@@ -1346,52 +1788,28 @@ def plot_spectra_multi_electron_fitted():
         frameon=False)
     for color, text in zip(colors_plot, leg.get_texts()):
         text.set_color(color)
-    ax.text(
-        0.05,
-        0.65,
-        'R5',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.74,
-        'R3',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.83,
-        'R2',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.91,
-        'R4',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    dir = '../img/spectra/'
-    if not os.path.isdir(dir):
-        os.makedirs(dir)
-    fname = dir + 'spect_multi_electron_fitted.eps'
-    fig.savefig(fname)
+    labels = [
+        (0.05, 0.65, 'R5', 0, 0),
+        (0.05, 0.74, 'R3', 1, 0),
+        (0.05, 0.83, 'R2', 2, 0),
+        (0.05, 0.91, 'R4', 3, 0)]
+    for x, y, text, icolor, rotation in labels:
+        ax.text(
+            x,
+            y,
+            text,
+            color=colors[icolor],
+            fontsize=20,
+            rotation=rotation,
+            horizontalalignment='left',
+            verticalalignment='center',
+            transform=ax.transAxes)
 
-    plt.show()
+    fname = img_spectra_dir + 'spect_multi_electron_fitted.eps'
+    fig.savefig(fname)
+    if show_plots:
+        plt.show()
+    plt.close(fig)
 
 
 def plot_spectra_beta_ion():
@@ -1399,11 +1817,6 @@ def plot_spectra_beta_ion():
 
     """
     species = 'h'
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    img_dir = '../img/spectra/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
     fig = plt.figure(figsize=[7, 5])
     xs, ys = 0.15, 0.15
     w1, h1 = 0.8, 0.8
@@ -1419,47 +1832,33 @@ def plot_spectra_beta_ion():
     e_extend = 40
     colors_plot = []
     e_nth = 50
-    for run_name in run_names[:4]:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
-        dir = '../data/spectra/' + run_name + '/'
-        n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        ct = 1
-        fname = dir + 'spectrum-' + species + '.1'
-        file_exist = os.path.isfile(fname)
-        while file_exist:
-            ct += 1
-            fname = dir + 'spectrum-' + species + '.' + str(ct)
-            file_exist = os.path.isfile(fname)
-        fname = dir + 'spectrum-' + species + '.' + str(ct - 1)
-        elin, flin, elog, flog = get_energy_distribution(fname, n0)
-        elog_norm = get_normalized_energy(species, elog, pic_info)
-        flog *= shift[run]
-        fthermal = fit_thermal_core(elog, flog)
-        fnonthermal = flog - fthermal
+    elogs_norm, flogs, fnonthermals, power_fits = compute_spectra_panel(
+        run_names[:4], species, shift, offset, extent, nwhole=1)
+    for run in range(len(flogs)):
+        elog_norm = elogs_norm[run]
+        flog = flogs[run]
+        fnonthermal = fnonthermals[run]
         p1, = ax.loglog(elog_norm, flog, linewidth=2)
         color = p1.get_color()
         if run > 0:
             p11, = ax.loglog(
                 elog_norm[e_nth:], fnonthermal[e_nth:], color=color)
 
-        if run < 1:
-            power_fit = power_law_fit(elog, flog, offset[run], extent[run])
-        else:
-            power_fit = power_law_fit(elog, fnonthermal, offset[run],
-                                      extent[run])
+        power_fit = power_fits[run]
         # power_fit = power_law_fit(elog, flog, 90, 30)
         # power_fit = power_law_fit(elog, fnonthermal, 35, 70)
         es, ee = power_fit.es, power_fit.ee
         fpower = power_fit.fpower
         es -= e_extend
         ee += e_extend
+        sl = slice(max(es, 0), min(ee, fpower.size))
+        elog_plot, fpower_plot = elog_norm[sl], fpower[sl] * 2
         powerIndex = "{%0.2f}" % power_fit.params[0]
         pname = r'$\sim \varepsilon^{' + powerIndex + '}$'
         if run > 0:
             p23, = ax.loglog(
-                elog_norm[es:ee],
-                fpower[es:ee] * 2,
+                elog_plot,
+                fpower_plot,
                 color=color,
                 linestyle='--',
                 linewidth=2,
@@ -1478,7 +1877,6 @@ def plot_spectra_beta_ion():
         ax.set_xlim([2E-1, 4E3])
         ax.set_ylim([1E-3, 5E7])
         # shift *= 5
-        run += 1
 
     ax.set_xlabel(
         r'$\varepsilon/\varepsilon_\text{th}$', fontdict=font, fontsize=24)
@@ -1493,93 +1891,32 @@ def plot_spectra_beta_ion():
         frameon=False)
     for color, text in zip(colors_plot, leg.get_texts()):
         text.set_color(color)
-    ax.text(
-        0.45,
-        0.05,
-        'R8',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.59,
-        0.05,
-        'R7',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.78,
-        0.05,
-        'R1',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.92,
-        0.05,
-        'R6',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-
-    ax.text(
-        0.42,
-        0.25,
-        r'$\beta_e=0.2$',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes,
-        rotation=-60)
-    ax.text(
-        0.55,
-        0.25,
-        r'$\beta_e=0.07$',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes,
-        rotation=-60)
-    ax.text(
-        0.75,
-        0.25,
-        r'$\beta_e=0.02$',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes,
-        rotation=-60)
-    ax.text(
-        0.85,
-        0.33,
-        r'$\beta_e=0.007$',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes,
-        rotation=-60)
-
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    dir = '../img/spectra/'
-    if not os.path.isdir(dir):
-        os.makedirs(dir)
-    fname = dir + 'spect_beta_ion.eps'
-    fig.savefig(fname)
+    labels = [
+        (0.45, 0.05, 'R8', 0, 0),
+        (0.59, 0.05, 'R7', 1, 0),
+        (0.78, 0.05, 'R1', 2, 0),
+        (0.92, 0.05, 'R6', 3, 0),
+        (0.42, 0.25, r'$\beta_e=0.2$', 0, -60),
+        (0.55, 0.25, r'$\beta_e=0.07$', 1, -60),
+        (0.75, 0.25, r'$\beta_e=0.02$', 2, -60),
+        (0.85, 0.33, r'$\beta_e=0.007$', 3, -60)]
+    for x, y, text, icolor, rotation in labels:
+        ax.text(
+            x,
+            y,
+            text,
+            color=colors[icolor],
+            fontsize=20,
+            rotation=rotation,
+            horizontalalignment='left',
+            verticalalignment='center',
+            transform=ax.transAxes)
 
-    plt.show()
+    fname = img_spectra_dir + 'spect_beta_ion.eps'
+    fig.savefig(fname)
+    if show_plots:
+        plt.show()
+    plt.close(fig)
 
 
 def plot_spectra_multi_ion():
@@ -1587,11 +1924,6 @@ def plot_spectra_multi_ion():
 
     """
     species = 'h'
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    img_dir = '../img/spectra/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
     fig = plt.figure(figsize=[7, 5])
     xs, ys = 0.15, 0.15
     w1, h1 = 0.8, 0.8
@@ -1608,41 +1940,29 @@ def plot_spectra_multi_ion():
     colors_plot = []
     e_nth = [200, 150, 200, 250]
     ng = 3
-    kernel = np.ones(ng) / float(ng)
-    for run_name in run_names[4:8]:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
-        dir = '../data/spectra/' + run_name + '/'
-        n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        ct = 1
-        fname = dir + 'spectrum-' + species + '.1'
-        file_exist = os.path.isfile(fname)
-        while file_exist:
-            ct += 1
-            fname = dir + 'spectrum-' + species + '.' + str(ct)
-            file_exist = os.path.isfile(fname)
-        fname = dir + 'spectrum-' + species + '.' + str(ct - 1)
-        elin, flin, elog, flog = get_energy_distribution(fname, n0)
-        elog_norm = get_normalized_energy(species, elog, pic_info)
-        flog *= shift[run]
-        flog = np.convolve(flog, kernel, 'same')
-        fthermal = fit_thermal_core(elog, flog)
-        fnonthermal = flog - fthermal
+    elogs_norm, flogs, fnonthermals, power_fits = compute_spectra_panel(
+        run_names[4:8], species, shift, offset, extent, ng=ng)
+    for run in range(len(flogs)):
+        elog_norm = elogs_norm[run]
+        flog = flogs[run]
+        fnonthermal = fnonthermals[run]
         p1, = ax.loglog(elog_norm, flog, linewidth=2)
         color = p1.get_color()
         p11, = ax.loglog(
             elog_norm[e_nth[run]:], fnonthermal[e_nth[run]:], color=color)
         # power_fit = power_law_fit(elog, fnonthermal, 310, 50)
-        power_fit = power_law_fit(elog, fnonthermal, offset[run], extent[run])
+        power_fit = power_fits[run]
         es, ee = power_fit.es, power_fit.ee
         fpower = power_fit.fpower
         powerIndex = "{%0.2f}" % power_fit.params[0]
         pname = r'$\sim \varepsilon^{' + powerIndex + '}$'
         es -= e_extend
         ee += e_extend
+        sl = slice(max(es, 0), min(ee, fpower.size))
+        elog_plot, fpower_plot = elog_norm[sl], fpower[sl] * 2
         p23, = ax.loglog(
-            elog_norm[es:ee],
-            fpower[es:ee] * 2,
+            elog_plot,
+            fpower_plot,
             color=color,
             linestyle='--',
             linewidth=2,
@@ -1658,7 +1978,6 @@ def plot_spectra_multi_ion():
         ax.set_xlim([1E-1, 2E3])
         ax.set_ylim([1E-3, 5E7])
         # shift *= 5
-        run += 1
 
     ax.set_xlabel(
         r'$\varepsilon/\varepsilon_\text{th}$', fontdict=font, fontsize=24)
@@ -1673,52 +1992,28 @@ def plot_spectra_multi_ion():
         frameon=False)
     for color, text in zip(colors_plot, leg.get_texts()):
         text.set_color(color)
-    ax.text(
-        0.05,
-        0.58,
-        'R5',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.7,
-        'R3',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.83,
-        'R2',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.91,
-        'R4',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    dir = '../img/spectra/'
-    if not os.path.isdir(dir):
-        os.makedirs(dir)
-    fname = dir + 'spect_multi_ion.eps'
-    fig.savefig(fname)
+    labels = [
+        (0.05, 0.58, 'R5', 0, 0),
+        (0.05, 0.7, 'R3', 1, 0),
+        (0.05, 0.83, 'R2', 2, 0),
+        (0.05, 0.91, 'R4', 3, 0)]
+    for x, y, text, icolor, rotation in labels:
+        ax.text(
+            x,
+            y,
+            text,
+            color=colors[icolor],
+            fontsize=20,
+            rotation=rotation,
+            horizontalalignment='left',
+            verticalalignment='center',
+            transform=ax.transAxes)
 
-    plt.show()
+    fname = img_spectra_dir + 'spect_multi_ion.eps'
+    fig.savefig(fname)
+    if show_plots:
+        plt.show()
+    plt.close(fig)
 
 
 def plot_guide_electron():
@@ -1726,41 +2021,27 @@ def plot_guide_electron():
 
     """
     species = 'e'
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    img_dir = '../img/spectra/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
     fig = plt.figure(figsize=[7, 5])
     xs, ys = 0.15, 0.15
     w1, h1 = 0.8, 0.8
     ax = fig.add_axes([xs, ys, w1, h1])
     ax.set_color_cycle(colors)
-    base_dirs, run_names = guide_field_runs()
-    nruns = len(run_names)
+    _, run_names = guide_field_runs()
     shift = 1
-    offset = [50, 70, 70, 80, 40]
-    extent = [100, 50, 40, 40, 40]
+    offset = guide_electron_offset
+    extent = guide_electron_extent
     run = 0
     e_extend = 20
     colors_plot = []
     e_nth = 200
     for run_name in run_names:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
+        pic_info = get_run_pic_info(run_name)
         dir = '../data/spectra/' + run_name + '/'
         n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        ct = 1
-        fname = dir + 'spectrum-' + species + '.1'
-        file_exist = os.path.isfile(fname)
-        while file_exist:
-            ct += 1
-            fname = dir + 'spectrum-' + species + '.' + str(ct)
-            file_exist = os.path.isfile(fname)
-        fname = dir + 'spectrum-' + species + '.' + str(ct - 1)
-        elin, flin, elog, flog = get_energy_distribution(fname, n0)
+        fname = last_spectrum_file(dir, species)
+        elin, flin, elog, flog = get_energy_distribution_cached(fname, n0)
         elog_norm = get_normalized_energy(species, elog, pic_info)
-        flog *= shift
+        flog = flog * shift
         fthermal = fit_thermal_core(elog, flog)
         fnonthermal = flog - fthermal
         p1, = ax.loglog(elog_norm, flog, linewidth=2)
@@ -1776,14 +2057,15 @@ def plot_guide_electron():
                                       extent[run])
         es, ee = power_fit.es, power_fit.ee
         fpower = power_fit.fpower
-        color = p1.get_color()
         es -= e_extend
         ee += e_extend
+        sl = slice(max(es, 0), min(ee, fpower.size))
+        elog_plot, fpower_plot = elog_norm[sl], fpower[sl] * 2
         powerIndex = "{%0.2f}" % power_fit.params[0]
         pname = r'$\sim \varepsilon^{' + powerIndex + '}$'
         p23, = ax.loglog(
-            elog_norm[es:ee],
-            fpower[es:ee] * 2,
+            elog_plot,
+            fpower_plot,
             color=color,
             linestyle='--',
             linewidth=2,
@@ -1820,61 +2102,28 @@ def plot_guide_electron():
         frameon=False)
     for color, text in zip(colors_plot, leg.get_texts()):
         text.set_color(color)
-    ax.text(
-        0.05,
-        0.6,
-        r'$B_g=0$',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.7,
-        r'$B_g=0.2$',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.8,
-        r'$B_g=0.5$',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.05,
-        0.9,
-        r'$B_g=1.0$',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.4,
-        0.93,
-        r'$B_g=4.0$',
-        color=colors[4],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    dir = '../img/spectra/'
-    if not os.path.isdir(dir):
-        os.makedirs(dir)
-    fname = dir + 'spect_guide_electron.eps'
-    fig.savefig(fname, transparent=True)
+    labels = [
+        (0.05, 0.6, r'$B_g=0$', 0),
+        (0.05, 0.7, r'$B_g=0.2$', 1),
+        (0.05, 0.8, r'$B_g=0.5$', 2),
+        (0.05, 0.9, r'$B_g=1.0$', 3),
+        (0.4, 0.93, r'$B_g=4.0$', 4)]
+    for x, y, text, icolor in labels:
+        ax.text(
+            x,
+            y,
+            text,
+            color=colors[icolor],
+            fontsize=20,
+            horizontalalignment='left',
+            verticalalignment='center',
+            transform=ax.transAxes)
 
-    plt.show()
+    fname = img_spectra_dir + 'spect_guide_electron.eps'
+    fig.savefig(fname, transparent=True)
+    if show_plots:
+        plt.show()
+    plt.close(fig)
 
 
 def plot_guide_ion():
@@ -1882,42 +2131,27 @@ def plot_guide_ion():
 
     """
     species = 'h'
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    img_dir = '../img/spectra/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
     fig = plt.figure(figsize=[7, 5])
     xs, ys = 0.15, 0.15
     w1, h1 = 0.8, 0.8
     ax = fig.add_axes([xs, ys, w1, h1])
     ax.set_color_cycle(colors)
-    base_dirs, run_names = guide_field_runs()
-    nruns = len(run_names)
+    _, run_names = guide_field_runs()
     shift = 1
-    offset = [40, 40, 40, 40, 70]
-    extent = [25, 25, 25, 25, 35]
+    offset = guide_ion_offset
+    extent = guide_ion_extent
     run = 0
     e_extend = 20
-    colors_plot = []
     e_nth = 80
     plots = []
     for run_name in run_names:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
+        pic_info = get_run_pic_info(run_name)
         dir = '../data/spectra/' + run_name + '/'
         n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-        ct = 1
-        fname = dir + 'spectrum-' + species + '.1'
-        file_exist = os.path.isfile(fname)
-        while file_exist:
-            ct += 1
-            fname = dir + 'spectrum-' + species + '.' + str(ct)
-            file_exist = os.path.isfile(fname)
-        fname = dir + 'spectrum-' + species + '.' + str(ct - 1)
-        elin, flin, elog, flog = get_energy_distribution(fname, n0)
+        fname = last_spectrum_file(dir, species)
+        elin, flin, elog, flog = get_energy_distribution_cached(fname, n0)
         elog_norm = get_normalized_energy(species, elog, pic_info)
-        flog *= shift
+        flog = flog * shift
         fthermal = fit_thermal_core(elog, flog)
         fnonthermal = flog - fthermal
         p1, = ax.loglog(elog_norm, flog, linewidth=2)
@@ -1927,20 +2161,20 @@ def plot_guide_ion():
         power_fit = power_law_fit(elog, fnonthermal, offset[run], extent[run])
         es, ee = power_fit.es, power_fit.ee
         fpower = power_fit.fpower
-        color = p1.get_color()
         es -= e_extend
         ee += e_extend
+        sl = slice(max(es, 0), min(ee, fpower.size))
+        elog_plot, fpower_plot = elog_norm[sl], fpower[sl] * 2
         powerIndex = "{%0.2f}" % power_fit.params[0]
         pname = r'$\sim \varepsilon^{' + powerIndex + '}$'
         p23, = ax.loglog(
-            elog_norm[es:ee],
-            fpower[es:ee] * 2,
+            elog_plot,
+            fpower_plot,
             color=color,
             linestyle='--',
             linewidth=2,
             label=pname)
         plots.append(p23)
-        colors_plot.append(color)
         # # Help for fitting
         # p21, = ax.loglog(elog_norm[es], fnonthermal[es], marker='.',
         #         markersize=10, linestyle='None', color=color)
@@ -1977,61 +2211,28 @@ def plot_guide_ion():
         text.set_color(color)
     for color, text in zip(colors[3:], leg2.get_texts()):
         text.set_color(color)
-    ax.text(
-        0.02,
-        0.59,
-        r'$B_g=0$',
-        color=colors[0],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.02,
-        0.69,
-        r'$B_g=0.2$',
-        color=colors[1],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.02,
-        0.78,
-        r'$B_g=0.5$',
-        color=colors[2],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.02,
-        0.88,
-        r'$B_g=1.0$',
-        color=colors[3],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-    ax.text(
-        0.25,
-        0.93,
-        r'$B_g=4.0$',
-        color=colors[4],
-        fontsize=20,
-        horizontalalignment='left',
-        verticalalignment='center',
-        transform=ax.transAxes)
-
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    dir = '../img/spectra/'
-    if not os.path.isdir(dir):
-        os.makedirs(dir)
-    fname = dir + 'spect_guide_ion.eps'
-    fig.savefig(fname, transparent=True)
+    labels = [
+        (0.02, 0.59, r'$B_g=0$', 0),
+        (0.02, 0.69, r'$B_g=0.2$', 1),
+        (0.02, 0.78, r'$B_g=0.5$', 2),
+        (0.02, 0.88, r'$B_g=1.0$', 3),
+        (0.25, 0.93, r'$B_g=4.0$', 4)]
+    for x, y, text, icolor in labels:
+        ax.text(
+            x,
+            y,
+            text,
+            color=colors[icolor],
+            fontsize=20,
+            horizontalalignment='left',
+            verticalalignment='center',
+            transform=ax.transAxes)
 
-    plt.show()
+    fname = img_spectra_dir + 'spect_guide_ion.eps'
+    fig.savefig(fname, transparent=True)
+    if show_plots:
+        plt.show()
+    plt.close(fig)
 
 
 def get_maximum_energy_multi(species):
@@ -2042,8 +2243,7 @@ def get_maximum_energy_multi(species):
     emax = np.zeros(nruns)
     run = 0
     for run_name in run_names:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
+        pic_info = get_run_pic_info(run_name)
         dir = '../data/spectra/' + run_name + '/'
         ntp = pic_info.ntp
         emax_time = maximum_energy_particle(species, pic_info, dir)
@@ -2053,26 +2253,52 @@ def get_maximum_energy_multi(species):
         print("%s %6.2f" % (run_names[i], emax[i]))
 
 
-def plot_maximum_energy_multi():
+def plot_maximum_energy_single(run_name, img_dir, fig=None):
+    """Plot and save the evolution of the maximum energy for one run
+
+    Args:
+        run_name: the name of the PIC run.
+        img_dir: the directory to save the figure.
+        fig: the figure to reuse, which is left open for the next run.
+            A new figure is created and closed if it is None.
+    """
+    pic_info = get_run_pic_info(run_name)
+    dir = '../data/spectra/' + run_name + '/'
+    new_fig = fig is None
+    fig = plot_maximum_energy(pic_info, dir, fig)
+    fname = img_dir + 'emax_' + run_name + '.eps'
+    fig.savefig(fname)
+    if new_fig:
+        plt.close(fig)
+
+
+def plot_maximum_energy_multi(singlecore=False):
     """Plot the evolution of the maximum energy for multiple runs
+
+    The runs are independent, so they are plotted in parallel processes.
+
+    Args:
+        singlecore: whether to plot the runs one by one in this process,
+            e.g. for debugging.
     """
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
     img_dir = '../img/emax/'
-    if not os.path.isdir(img_dir):
-        os.makedirs(img_dir)
+    mkdir_p(img_dir)
     base_dirs, run_names = ApJ_long_paper_runs()
-    nruns = len(run_names)
-    emax = np.zeros(nruns)
-    run = 0
-    for run_name in run_names:
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
-        dir = '../data/spectra/' + run_name + '/'
-        plot_maximum_energy(pic_info, dir)
-        fname = img_dir + 'emax_' + run_name + '.eps'
-        plt.savefig(fname)
-        plt.close()
+    if singlecore:
+        # Plot all the runs on the same figure
+        fig = plt.figure(figsize=[7, 5])
+        for i, run_name in enumerate(run_names, 1):
+            plot_maximum_energy_single(run_name, img_dir, fig)
+            if i % 8 == 0:
+                gc.collect()
+        plt.close(fig)
+    else:
+        ncores = multiprocessing.cpu_count()
+        # Fork the workers, so they keep the backend and rc settings made
+        # when this module is imported
+        Parallel(n_jobs=ncores, backend='multiprocessing')(
+            delayed(plot_maximum_energy_single)(run_name, img_dir)
+            for run_name in run_names)
 
 
 def plot_spectrum_series(species, pic_info, fpath, **kwargs):
@@ -2082,6 +2308,9 @@ def plot_spectrum_series(species, pic_info, fpath, **kwargs):
         species: particle species. 'e' for electron, 'h' for ion.
         pic_info: namedtuple for the PIC simulation information.
         fpath: file path that has the particle spectra data.
+
+    Returns:
+        fig: the figure of the spectra.
     """
     ntp = pic_info.ntp
     # ntp = 138
@@ -2090,23 +2319,40 @@ def plot_spectrum_series(species, pic_info, fpath, **kwargs):
     w1, h1 = 0.8, 0.8
     ax = fig.add_axes([xs, ys, w1, h1])
     ax.grid(True)
-    kwargs_plot = {
-        "fpath": fpath,
-        "is_thermal": False,
-        "is_power": False,
-        "xlim": kwargs["xlim"],
-        "ylim": kwargs["ylim"],
-        "color": 'k'
-    }
+    # Draw the spectra and the thermal cores of all the time frames as one
+    # collection instead of two lines for each time frame. The thermal core
+    # of each time frame follows its spectrum, so they are layered in the
+    # same order as the lines.
+    segments, segment_colors, segment_styles = [], [], []
+    # Read all the spectra at once and take the rows of the time frames
+    tframes_all, cube = read_spectrum_cube(fpath, species)
+    rows = dict((ct, i) for i, ct in enumerate(tframes_all))
     for ct in range(1, ntp - 1):
-        color = plt.cm.jet(ct / float(ntp), 1)
-        kwargs_plot["color"] = color
-        plot_spectrum(ct, species, ax, pic_info, **kwargs_plot)
-    kwargs_plot["color"] = 'k'
-    # plot_spectrum(1, species, ax, pic_info, **kwargs_plot)
-    # kwargs_plot["is_thermal"] = True
-    # kwargs_plot["color"] = 'b'
-    # plot_spectrum(ntp-1, species, ax, pic_info, **kwargs_plot)
+        data = cube[rows[ct]] if ct in rows else None
+        spect = spectrum_thermal_fits(ct, species, pic_info, fpath, data)
+        if spect is None:
+            continue
+        elog, flog, fthermal, fnonthermal, fthermal1 = spect
+        # Mask the non-positive values as ax.loglog does
+        segments.append(np.column_stack([elog,
+                                         np.where(flog > 0, flog, np.nan)]))
+        segment_colors.append(plt.cm.jet(ct / float(ntp), 1))
+        segment_styles.append('solid')
+        segments.append(
+            np.column_stack([elog, np.where(fthermal1 > 0, fthermal1,
+                                            np.nan)]))
+        segment_colors.append('k')
+        segment_styles.append('--')
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    lc = LineCollection(
+        segments,
+        colors=segment_colors,
+        linestyles=segment_styles,
+        linewidths=2)
+    ax.add_collection(lc)
+    ax.set_xlim(kwargs["xlim"])
+    ax.set_ylim(kwargs["ylim"])
 
     # if (species == 'e'):
     #     vth = pic_info.vthe
@@ -2143,7 +2389,7 @@ def plot_spectrum_series(species, pic_info, fpath, **kwargs):
     nt1, = emax_time.shape
     nt2, = tparticles.shape
     nt = min(nt1, nt2)
-    tparticles /= 100
+    tparticles = tparticles / 100
     ax1.plot(tparticles[:nt], emax_time[:nt], linewidth=2, color='k')
     ax1.set_xlabel(r'$t\Omega_{ci}/100$', fontdict=font, fontsize=16)
     ax1.set_ylabel(
@@ -2151,6 +2397,7 @@ def plot_spectrum_series(species, pic_info, fpath, **kwargs):
         fontdict=font,
         fontsize=16)
     ax1.tick_params(labelsize=12)
+    return fig
 
 
 def plot_spectra_time_multi(species):
@@ -2161,33 +2408,28 @@ def plot_spectra_time_multi(species):
     """
     base_dirs, run_names = ApJ_long_paper_runs()
     # base_dirs, run_names = guide_field_runs()
-    if not os.path.isdir('../img/'):
-        os.makedirs('../img/')
-    fig_dir = '../img/spectra/'
-    if not os.path.isdir(fig_dir):
-        os.makedirs(fig_dir)
-    nrun = len(run_names)
-    xlims = np.zeros((nrun, 2))
-    ylims = np.zeros((nrun, 2))
+    fig_dir = img_spectra_dir
     if species == 'e':
-        xlims[0, :] = [5E-2, 2E2]
-        ylims[0, :] = [1E-5, 2E2]
-        xlims[1, :] = [5E-2, 2E2]
-        ylims[1, :] = [1E-5, 2E2]
-        xlims[2, :] = [5E-2, 2E2]
-        ylims[2, :] = [1E-5, 2E2]
-        xlims[3, :] = [5E-2, 6E2]
-        ylims[3, :] = [1E-5, 2E2]
-        xlims[4, :] = [5E-2, 2E2]
-        ylims[4, :] = [1E-5, 2E2]
-        xlims[5, :] = [5E-2, 3E2]
-        ylims[5, :] = [1E-5, 2E3]
-        xlims[6, :] = [5E-2, 3E2]
-        ylims[6, :] = [1E-5, 5E2]
-        xlims[7, :] = [5E-2, 3E2]
-        ylims[7, :] = [1E-5, 2E2]
-        xlims[8, :] = [5E-2, 3E2]
-        ylims[8, :] = [1E-5, 2E2]
+        xlims = np.array([
+            [5E-2, 2E2],
+            [5E-2, 2E2],
+            [5E-2, 2E2],
+            [5E-2, 6E2],
+            [5E-2, 2E2],
+            [5E-2, 3E2],
+            [5E-2, 3E2],
+            [5E-2, 3E2],
+            [5E-2, 3E2]])
+        ylims = np.array([
+            [1E-5, 2E2],
+            [1E-5, 2E2],
+            [1E-5, 2E2],
+            [1E-5, 2E2],
+            [1E-5, 2E2],
+            [1E-5, 2E3],
+            [1E-5, 5E2],
+            [1E-5, 2E2],
+            [1E-5, 2E2]])
         # xlims[0,:] = [5E-2, 2E2]
         # ylims[0,:] = [1E-5, 2E2]
         # xlims[1,:] = [5E-2, 2E2]
@@ -2199,24 +2441,26 @@ def plot_spectra_time_multi(species):
         # xlims[4,:] = [5E-2, 2E2]
         # ylims[4,:] = [1E-5, 2E2]
     else:
-        xlims[0, :] = [5E-2, 2E2]
-        ylims[0, :] = [1E-5, 2E2]
-        xlims[1, :] = [5E-2, 2E2]
-        ylims[1, :] = [1E-5, 2E2]
-        xlims[2, :] = [2E-1, 7E2]
-        ylims[2, :] = [1E-5, 2E2]
-        xlims[3, :] = [2E-1, 2E3]
-        ylims[3, :] = [1E-5, 2E2]
-        xlims[4, :] = [5E-2, 7E2]
-        ylims[4, :] = [1E-5, 2E2]
-        xlims[5, :] = [5E-2, 6E2]
-        ylims[5, :] = [1E-5, 2E3]
-        xlims[6, :] = [5E-2, 7E2]
-        ylims[6, :] = [1E-5, 5E2]
-        xlims[7, :] = [5E-2, 7E2]
-        ylims[7, :] = [1E-5, 2E2]
-        xlims[8, :] = [2E-1, 3E2]
-        ylims[8, :] = [1E-5, 2E2]
+        xlims = np.array([
+            [5E-2, 2E2],
+            [5E-2, 2E2],
+            [2E-1, 7E2],
+            [2E-1, 2E3],
+            [5E-2, 7E2],
+            [5E-2, 6E2],
+            [5E-2, 7E2],
+            [5E-2, 7E2],
+            [2E-1, 3E2]])
+        ylims = np.array([
+            [1E-5, 2E2],
+            [1E-5, 2E2],
+            [1E-5, 2E2],
+            [1E-5, 2E2],
+            [1E-5, 2E2],
+            [1E-5, 2E3],
+            [1E-5, 5E2],
+            [1E-5, 2E2],
+            [1E-5, 2E2]])
         # xlims[0,:] = [2E-1, 7E2]
         # ylims[0,:] = [1E-5, 2E2]
         # xlims[1,:] = [2E-1, 5E2]
@@ -2229,16 +2473,18 @@ def plot_spectra_time_multi(species):
         # ylims[4,:] = [1E-5, 2E2]
     for i in range(1):
         run_name = run_names[i]
-        picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-        pic_info = read_data_from_json(picinfo_fname)
+        pic_info = get_run_pic_info(run_name)
         dir = '../data/spectra/' + run_name + '/'
         n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
         kwargs = {"xlim": xlims[i], "ylim": ylims[i]}
-        plot_spectrum_series(species, pic_info, dir, **kwargs)
+        fig = plot_spectrum_series(species, pic_info, dir, **kwargs)
         fname = fig_dir + 'spect_time_' + run_name + '_' + species + '.eps'
-        plt.savefig(fname)
-        plt.show()
-        # plt.close()
+        fig.savefig(fname)
+        if show_plots:
+            plt.show()
+        plt.close(fig)
+        if (i + 1) % 8 == 0:
+            gc.collect()
 
 
 def plot_final_energy_spectrum():
@@ -2247,26 +2493,18 @@ def plot_final_energy_spectrum():
     """
     species = 'e'
     run_name = 'mime25_beta0007'
-    picinfo_fname = '../data/pic_info/pic_info_' + run_name + '.json'
-    pic_info = read_data_from_json(picinfo_fname)
+    pic_info = get_run_pic_info(run_name)
     fdir = '../data/spectra/' + run_name + '/'
     n0 = pic_info.nx * pic_info.ny * pic_info.nz * pic_info.nppc
-    ct = 1
-    fname = fdir + 'spectrum-' + species + '.1'
-    file_exist = os.path.isfile(fname)
-    while file_exist:
-        ct += 1
-        fname = fdir + 'spectrum-' + species + '.' + str(ct)
-        file_exist = os.path.isfile(fname)
-
-    fname = fdir + 'spectrum-' + species + '.' + str(ct - 1)
-    elin, flin, elog, flog_e = get_energy_distribution(fname, n0)
+    ct = list_spectrum_frames(fdir, species)[-1]
+    fname = fdir + 'spectrum-' + species + '.' + str(ct)
+    elin, flin, elog, flog_e = get_energy_distribution_cached(fname, n0)
     elog_norm_e = get_normalized_energy(species, elog, pic_info)
     nacc, eacc = accumulated_particle_info(elog_norm_e, flog_e)
     flog_e /= nacc[-1]
 
-    fname = fdir + 'spectrum-h.' + str(ct - 1)
-    elin, flin, elog, flog_i = get_energy_distribution(fname, n0)
+    fname = fdir + 'spectrum-h.' + str(ct)
+    elin, flin, elog, flog_i = get_energy_distribution_cached(fname, n0)
     elog_norm_i = get_normalized_energy('i', elog, pic_info)
     nacc, eacc = accumulated_particle_info(elog_norm_i, flog_i)
     flog_i /= nacc[-1]
@@ -2275,8 +2513,7 @@ def plot_final_energy_spectrum():
         vth = pic_info.vthe
     else:
         vth = pic_info.vthi
-    gama = 1.0 / math.sqrt(1.0 - 3 * vth**2)
-    eth = gama - 1.0
+    eth = thermal_energy(vth)
     f_intial = fitting_funcs.func_maxwellian(elog, n0, 1.5 / eth)
     nacc, eacc = accumulated_particle_info(elog_norm_e, f_intial)
     f_intial /= nacc[-1]
@@ -2307,8 +2544,9 @@ def plot_final_energy_spectrum():
     mkdir_p(img_path)
     fname = img_path + 'final_spectra_' + run_name + '.eps'
     fig.savefig(fname)
-
-    plt.show()
+    if show_plots:
+        plt.show()
+    plt.close(fig)
 
 
 if __name__ == "__main__":